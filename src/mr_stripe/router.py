@@ -1,17 +1,37 @@
-from fastapi import APIRouter, Request, HTTPException
-from .mod import process_single_payment, product_checkout, subscription_checkout, normalize_subscription_event
-import stripe
+from fastapi import APIRouter, Request, HTTPException, Response
+from .mod import enqueue_payment, get_stripe, product_checkout, subscription_checkout
+from . import mod
+import asyncio
+import hashlib
+import hmac
+import json
 import os
+import time
 from decimal import Decimal
 from typing import Optional
 from fastapi.responses import RedirectResponse
 from pydantic import BaseModel
-from lib.providers.services import service_manager
 from loguru import logger
 from lib.route_decorators import public_route, public_routes
 
+# Webhook payloads are several KB of nested JSON; orjson parses them 2-5x
+# faster than stdlib json when it's installed
+try:
+    import orjson
+
+    _json_loads = orjson.loads
+
+    def _json_response(data) -> Response:
+        return Response(orjson.dumps(data), media_type="application/json")
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_response(data) -> Response:
+        return Response(json.dumps(data).encode(), media_type="application/json")
+
 class ProductCheckoutRequest(BaseModel):
-    amount: Decimal
+    amount: Optional[Decimal] = None  # legacy dollar amount
+    amount_cents: Optional[int] = None  # preferred: integer cents, no Decimal math
     product_name: str
     currency: str = 'USD'
     quantity: int = 1
@@ -19,79 +39,123 @@ class ProductCheckoutRequest(BaseModel):
 
 class SubscriptionCheckoutRequest(BaseModel):
     plan_name: str
-    amount: Decimal
+    amount: Optional[Decimal] = None  # legacy dollar amount
+    amount_cents: Optional[int] = None  # preferred: integer cents, no Decimal math
     interval: str  # 'month' or 'year'
     currency: str = 'USD'
     metadata: Optional[dict] = None
 
+def _resolve_cents(amount_cents: Optional[int], amount: Optional[Decimal]) -> int:
+    """Resolve the two amount fields to integer cents, converting Decimal once"""
+    if amount_cents is not None:
+        if not 0 < amount_cents < 10_000_000:
+            raise HTTPException(status_code=400, detail="amount_cents out of range")
+        return amount_cents
+    if amount is None:
+        raise HTTPException(status_code=400, detail="amount or amount_cents is required")
+    return int((amount * 100).to_integral_value())
+
 router = APIRouter()
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
 
-# change to blue background yellow text
-print("\033[44;33m")
-print("-------------------------- Loaded router.py in mr_stripe ------------------------------------ ")
-print("Current public routes:")
-print(public_routes)
-# switch to norml text
-print("\033[0m")
+# Webhook signature verification is pure compute on the hot path, so do it
+# with a precomputed secret instead of paying the Stripe SDK's per-call
+# header re-parse and object construction. Bound once at import; a missing
+# secret gets one loud warning here rather than a rejection per delivery.
+WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+if not WEBHOOK_SECRET:
+    logger.warning("STRIPE_WEBHOOK_SECRET is not set; webhook deliveries will be rejected")
+_WH_SECRET = (WEBHOOK_SECRET or "").encode()
+_SIG_TOLERANCE = 300  # seconds, same default as the Stripe SDK
+
+# HMAC with the key schedule (ipad/opad mixing) already done; each
+# verification copies it instead of re-initializing from the secret
+_HMAC_PROTO = hmac.new(_WH_SECRET, None, hashlib.sha256) if _WH_SECRET else None
+
+# Stripe only reads the status code of a webhook ack, never the body, so
+# answer with one prebuilt empty 200 instead of serializing JSON per event
+_OK = Response(status_code=200)
+
+# The webhook endpoint is unauthenticated until the signature check passes,
+# so cap the body size while streaming instead of buffering arbitrary input.
+# Expanded invoice events run ~100 KB; 1 MiB leaves plenty of headroom.
+_MAX_WEBHOOK_BODY = 1 << 20
+
+def _verify_signature(payload: bytes, sig_header: Optional[str]) -> bool:
+    """Verify a Stripe webhook signature header against the payload"""
+    if _HMAC_PROTO is None or not sig_header:
+        return False
+    timestamp = None
+    v1_sigs = []
+    for part in sig_header.split(','):
+        key, _, value = part.strip().partition('=')
+        if key == 't':
+            timestamp = value
+        elif key == 'v1':
+            v1_sigs.append(value)
+    if not timestamp or not v1_sigs:
+        return False
+    try:
+        if abs(time.time() - int(timestamp)) > _SIG_TOLERANCE:
+            return False
+    except ValueError:
+        return False
+    h = _HMAC_PROTO.copy()
+    h.update(timestamp.encode())
+    h.update(b".")
+    h.update(payload)
+    expected = h.hexdigest()
+    return any(hmac.compare_digest(expected, sig) for sig in v1_sigs)
 
+@router.on_event("shutdown")
+async def _close_stripe_client():
+    # Release pooled keep-alive sockets and the SDK executor when the app
+    # process is recycled
+    mod.shutdown()
 
+logger.debug(f"Loaded router.py in mr_stripe; public routes: {public_routes}")
 
-@router.post("/stripe/webhook")
+@router.post("/stripe/webhook", response_class=Response)
 @public_route()
 async def handle_webhook(request: Request):
-    payload = await request.body()
+    # Stream the body with an early size cap; oversized garbage is rejected
+    # before it's fully buffered or parsed
+    payload = bytearray()
+    async for chunk in request.stream():
+        payload.extend(chunk)
+        if len(payload) > _MAX_WEBHOOK_BODY:
+            logger.error("Rejecting oversized webhook body")
+            return Response(status_code=413)
     sig_header = request.headers.get('stripe-signature')
-    
+
+    if not _verify_signature(payload, sig_header):
+        logger.error("Invalid Stripe webhook signature")
+        return _json_response({"status": "error", "message": "invalid signature"})
+
     try:
-        # Verify and parse the webhook
-        event = stripe.Webhook.construct_event(
-            payload, 
-            sig_header,
-            os.getenv("STRIPE_WEBHOOK_SECRET")
-        )
-        
-        event_type = event['type']
-        logger.info(f"Processing Stripe webhook event: {event_type}")
-        
-        # Try to process as a one-time payment first
-        was_processed = await process_single_payment(event)
-        
-        # If it wasn't a one-time payment, check if it's a subscription event
-        if not was_processed and event_type in [
-            'checkout.session.completed', 'invoice.paid', 
-            'customer.subscription.updated', 'customer.subscription.deleted'
-        ]:
-            
-            # Normalize the event to subscription format
-            normalized_event = await normalize_subscription_event(event)
-            
-            # Forward to subscription plugin's event handler
-            if normalized_event.get('event_type'): # Ensure it's a valid normalized event
-                try:
-                    result = await service_manager.process_subscription_event({
-                        'provider': 'stripe',
-                        'normalized_event': normalized_event,
-                        'original_event': event
-                    })
-                    logger.info(f"Subscription event processed: {result}")
-                except Exception as e:
-                    logger.error(f"Error forwarding to subscription plugin: {e}")
-                    # Continue processing - don't fail the webhook
-        
-        return {"status": "success"}
+        event = _json_loads(payload)
+
+        logger.info(f"Queueing Stripe webhook event: {event['type']}")
+
+        # Ack immediately and let the background worker do the processing,
+        # so slow downstream calls can't push us past Stripe's delivery
+        # timeout and trigger retries
+        await enqueue_payment(event)
+
+        return _OK
     except Exception as e:
         logger.error(f"Error processing webhook: {e}")
         # Always return 200 to Stripe even on error
-        return {"status": "error", "message": str(e)}
+        return _json_response({"status": "error", "message": str(e)})
 
 @router.post("/stripe/checkout/product")
 async def handle_product_checkout(request: Request, checkout_data: ProductCheckoutRequest):
     user = request.state.user
+    # Resolve outside the try so its HTTPExceptions aren't re-wrapped below
+    amount = _resolve_cents(checkout_data.amount_cents, checkout_data.amount)
     try:
         url = await product_checkout(
             user_id=user.username,
-            amount=checkout_data.amount,
+            amount=amount,
             product_name=checkout_data.product_name,
             currency=checkout_data.currency,
             quantity=checkout_data.quantity,
@@ -105,11 +169,13 @@ async def handle_product_checkout(request: Request, checkout_data: ProductChecko
 @router.post("/stripe/checkout/subscription")
 async def handle_subscription_checkout(request: Request, checkout_data: SubscriptionCheckoutRequest):
     user = request.state.user
+    # Resolve outside the try so its HTTPExceptions aren't re-wrapped below
+    amount = _resolve_cents(checkout_data.amount_cents, checkout_data.amount)
     try:
         url = await subscription_checkout(
             user_id=user.username,
             plan_name=checkout_data.plan_name,
-            amount=checkout_data.amount,
+            amount=amount,
             interval=checkout_data.interval,
             currency=checkout_data.currency,
             metadata=checkout_data.metadata
@@ -123,8 +189,8 @@ async def handle_subscription_checkout(request: Request, checkout_data: Subscrip
 async def handle_checkout_success(request: Request, session_id: str):
     """Handle successful checkout redirect from Stripe"""
     try:
-        # Retrieve session details from Stripe
-        session = stripe.checkout.Session.retrieve(session_id)
+        # Retrieve session details from Stripe without blocking the event loop
+        session = await asyncio.to_thread(get_stripe().checkout.Session.retrieve, session_id)
         
         # Log the successful checkout
         logger.info(f"Successful Stripe checkout: {session_id} (mode: {session.mode})")